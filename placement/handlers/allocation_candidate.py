@@ -12,15 +12,20 @@
 
 """Placement API handlers for getting allocation candidates."""
 
-import collections
+import functools
+import itertools
+import operator
+import threading
+import time
 
+from oslo_config import cfg
 from oslo_serialization import jsonutils
-from oslo_utils import encodeutils
+from oslo_utils import importutils
 from oslo_utils import timeutils
-import six
 import webob
 
 from placement import exception
+from placement import lib as placement_lib
 from placement import microversion
 from placement.objects import resource_provider as rp_obj
 from placement.schemas import allocation_candidate as schema
@@ -29,12 +34,284 @@ from placement import wsgi_wrapper
 from nova.i18n import _
 
 
+CONF = cfg.CONF
+
+# orjson is a C extension that serializes directly to UTF-8 bytes and is
+# several times faster than jsonutils for the large nested dicts in an
+# allocation candidates response. It is optional; without it we fall
+# back to jsonutils plus an explicit encode.
+orjson = importutils.try_import('orjson')
+
+# Bound once at import so the per-request path pays a fast LOAD_GLOBAL
+# rather than module attribute lookups.
+_MV_KEY = microversion.MICROVERSION_ENVIRON
+_HTTPBadRequest = webob.exc.HTTPBadRequest
+
+
+class _Resources(object):
+    """Compact stand-in for a {"resources": {...}} wrapper dict.
+
+    A large candidates response holds one of these per (allocation
+    request, resource provider) pair, so a slotted object rather than a
+    single-key dict meaningfully cuts peak memory and GC pressure. The
+    JSON shape is produced by _json_default at serialization time.
+    """
+    __slots__ = ('resources',)
+
+    def __init__(self, resources):
+        self.resources = resources
+
+
+class _ProviderAllocation(object):
+    """Compact stand-in for the pre-1.12 allocation entry dict, which
+    has the shape:
+
+        {"resource_provider": {"uuid": $rp_uuid},
+         "resources": {$resource_class: $amount, ...}}
+
+    As with _Resources, the dict is only materialized by _json_default
+    when the response body is serialized.
+    """
+    __slots__ = ('rp_uuid', 'resources')
+
+    def __init__(self, rp_uuid, resources):
+        self.rp_uuid = rp_uuid
+        self.resources = resources
+
+
+def _json_default(obj):
+    """Serializer hook producing the JSON shape of the slotted holders."""
+    if isinstance(obj, _Resources):
+        return {'resources': obj.resources}
+    if isinstance(obj, _ProviderAllocation):
+        return {
+            'resource_provider': {
+                'uuid': obj.rp_uuid,
+            },
+            'resources': obj.resources,
+        }
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+def _dumps(data):
+    """Serialize data to UTF-8 encoded JSON bytes."""
+    if orjson is not None:
+        return orjson.dumps(data, default=_json_default)
+    return jsonutils.dumps(data, default=_json_default).encode('utf-8')
+
+
+# Fetching the resource provider uuid from a ResourceRequest or
+# ProviderSummary is two attribute lookups; the transform loops below do
+# it once per object via this getter (or a local alias) rather than
+# repeating the lookups inline.
+_RP_UUID = operator.attrgetter('resource_provider.uuid')
+
+
+# Query string schemas for GET, newest microversion boundary first. The
+# handler uses the first entry the request's microversion matches, so at
+# most one successful matches() call is made on average instead of
+# walking an if/elif ladder of disjoint checks.
+_GET_SCHEMA_TABLE = [
+    ((1, 21), schema.GET_SCHEMA_1_21),
+    ((1, 17), schema.GET_SCHEMA_1_17),
+    ((1, 16), schema.GET_SCHEMA_1_16),
+    ((1, 10), schema.GET_SCHEMA_1_10),
+]
+
+
+# (monotonic timestamp, timezone-aware datetime) pair backing _now_utc.
+# Replaced wholesale, never mutated, so the GIL makes the swap atomic
+# and no lock is needed.
+_LAST_MOD_CACHE = (0.0, None)
+
+
+def _now_utc():
+    """Return a timezone-aware utcnow that may be up to a second stale.
+
+    The last-modified header this feeds is a cache-control hint with
+    whole-second HTTP granularity, so constructing a fresh datetime for
+    every request is wasted work under load. The staleness check uses
+    the monotonic clock so a backwards wall-clock jump cannot pin the
+    cached value.
+    """
+    global _LAST_MOD_CACHE
+    now = time.monotonic()
+    ts, last_mod = _LAST_MOD_CACHE
+    if last_mod is not None and now - ts < 1.0:
+        return last_mod
+    last_mod = timeutils.utcnow(with_timezone=True)
+    _LAST_MOD_CACHE = (now, last_mod)
+    return last_mod
+
+
+@functools.lru_cache(maxsize=2048)
+def _parse_qs_cached(query_string, microversion_str):
+    """Parse a raw query string into a list of RequestGroup objects.
+
+    Scheduler retries frequently resubmit an identical query string, so
+    the parse result is memoized on the raw string (and the
+    microversion, in case a future microversion changes parsing
+    semantics). The cached groups must never be handed to code that may
+    mutate them; use _parse_request_groups, which copies them.
+    """
+    environ_req = webob.Request.blank('/?%s' % query_string)
+    return util.parse_qs_request_groups(environ_req.GET)
+
+
+def _copy_request_group(group):
+    """Return an independent copy of a cached RequestGroup.
+
+    The groups hold only flat containers, so a per-field copy is much
+    cheaper than a deepcopy pass.
+    """
+    return placement_lib.RequestGroup(
+        use_same_provider=group.use_same_provider,
+        resources=dict(group.resources),
+        required_traits=set(group.required_traits),
+        member_of=list(group.member_of))
+
+
+def _parse_request_groups(query_string, microversion_str):
+    """Return RequestGroups for the query string, safe to mutate.
+
+    The copies keep callers isolated from the groups shared in the
+    parse cache.
+    """
+    return [
+        _copy_request_group(group)
+        for group in _parse_qs_cached(query_string, microversion_str)]
+
+
+class _InFlight(object):
+    """A candidates database query being run on behalf of one or more
+    concurrent requests. The thread that created the entry assigns
+    result or exc and then flips published before signalling the event;
+    a signalled event with published still False means the owner was
+    killed (a BaseException such as GreenletExit or SystemExit) without
+    producing an outcome.
+    """
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exc = None
+        self.published = False
+
+
+# Map of in-flight candidate queries, keyed by (query string,
+# microversion), so that identical requests arriving while an equivalent
+# query is already running share its result instead of issuing another
+# database traversal.
+_IN_FLIGHT_LOCK = threading.Lock()
+_IN_FLIGHT = {}
+
+# How long a coalesced request will wait for the owning thread before
+# giving up and issuing its own query. This only matters if the owner
+# was killed without running its cleanup (an eventlet-style timeout
+# kill); the value just needs to comfortably exceed a slow query.
+_IN_FLIGHT_TIMEOUT = 30.0
+
+
+def _get_candidates_coalesced(context, key, requests, limit):
+    """Get allocation candidates, sharing in-flight database work.
+
+    When schedulers fan out, several identical GET requests commonly
+    arrive within the span of one database traversal. The first arrival
+    for a given key issues the query; subsequent arrivals with the same
+    key wait for it and share its result (or its exception). The query
+    is not filtered by the request context, so sharing results across
+    callers is safe.
+
+    When randomize_allocation_candidates is enabled the per-request
+    ordering (or random sample) of the results is what de-synchronizes
+    fanned-out schedulers, and handing every waiter the same result
+    would reintroduce exactly the herd behavior the option exists to
+    break, so coalescing is bypassed entirely in that case.
+    """
+    if CONF.placement.randomize_allocation_candidates:
+        return rp_obj.AllocationCandidates.get_by_requests(
+            context, requests, limit)
+
+    with _IN_FLIGHT_LOCK:
+        waiter = _IN_FLIGHT.get(key)
+        owner = waiter is None
+        if owner:
+            waiter = _InFlight()
+            _IN_FLIGHT[key] = waiter
+
+    if not owner:
+        # Bounded wait: if the owning thread was killed without running
+        # its cleanup, fall back to a direct query rather than hanging
+        # forever.
+        if not waiter.event.wait(_IN_FLIGHT_TIMEOUT):
+            # Evict the stale entry (guarded by identity in case a new
+            # owner has already replaced it) so only this request pays
+            # the wait; later arrivals start fresh.
+            with _IN_FLIGHT_LOCK:
+                if _IN_FLIGHT.get(key) is waiter:
+                    del _IN_FLIGHT[key]
+            return rp_obj.AllocationCandidates.get_by_requests(
+                context, requests, limit)
+        if not waiter.published:
+            # The owner was killed by a BaseException, so its cleanup
+            # signalled the event without publishing an outcome; issue
+            # our own query rather than returning a bogus None.
+            return rp_obj.AllocationCandidates.get_by_requests(
+                context, requests, limit)
+        if waiter.exc is not None:
+            raise waiter.exc
+        return waiter.result
+
+    try:
+        waiter.result = rp_obj.AllocationCandidates.get_by_requests(
+            context, requests, limit)
+        waiter.published = True
+        return waiter.result
+    except Exception as exc:
+        waiter.exc = exc
+        waiter.published = True
+        raise
+    finally:
+        with _IN_FLIGHT_LOCK:
+            if _IN_FLIGHT.get(key) is waiter:
+                del _IN_FLIGHT[key]
+        waiter.event.set()
+
+
+def _iter_candidates_body(a_reqs, p_sums):
+    """Incrementally serialize an allocation candidates response body.
+
+    Yields UTF-8 encoded JSON chunks, one per allocation request or
+    provider summary, so that the complete body bytes are never
+    materialized in a single buffer and transmission can begin before
+    serialization has finished.
+    """
+    yield b'{"allocation_requests":['
+    first = True
+    for a_req in a_reqs:
+        if first:
+            first = False
+        else:
+            yield b','
+        yield _dumps(a_req)
+    yield b'],"provider_summaries":{'
+    first = True
+    for rp_uuid, summary in p_sums.items():
+        if first:
+            first = False
+        else:
+            yield b','
+        yield _dumps(rp_uuid) + b':' + _dumps(summary)
+    yield b'}}'
+
+
 def _transform_allocation_requests_dict(alloc_reqs):
     """Turn supplied list of AllocationRequest objects into a list of
     allocations dicts keyed by resource provider uuid of resources involved
-    in the allocation request. The returned results are intended to be used
-    as the body of a PUT /allocations/{consumer_uuid} HTTP request at
-    micoversion 1.12 (and beyond). The JSON objects look like the following:
+    in the allocation request. The per-provider values are _Resources
+    holders, so the results are only serializable via this module's
+    _dumps; serialized that way they match the body of a PUT
+    /allocations/{consumer_uuid} HTTP request at microversion 1.12 (and
+    beyond) and look like the following:
 
     [
         {
@@ -56,26 +333,33 @@ def _transform_allocation_requests_dict(alloc_reqs):
         ...
     ]
     """
-    results = []
+    # Preallocate the output so the list does not repeatedly resize as
+    # it grows; the length is already known.
+    results = [None] * len(alloc_reqs)
 
-    for ar in alloc_reqs:
-        # A default dict of {$rp_uuid: "resources": {})
-        rp_resources = collections.defaultdict(lambda: dict(resources={}))
-        for rr in ar.resource_requests:
-            res_dict = rp_resources[rr.resource_provider.uuid]['resources']
-            res_dict[rr.resource_class] = rr.amount
-        results.append(dict(allocations=rp_resources))
+    for i, ar in enumerate(alloc_reqs):
+        # Group the resource requests by resource provider uuid so the
+        # allocations dict can be built in a single comprehension rather
+        # than with a defaultdict whose factory is called once per new
+        # provider.
+        rrs = sorted(ar.resource_requests, key=_RP_UUID)
+        rp_resources = {
+            rp_uuid: _Resources({
+                rr.resource_class: rr.amount for rr in grp})
+            for rp_uuid, grp in itertools.groupby(rrs, key=_RP_UUID)
+        }
+        results[i] = dict(allocations=rp_resources)
 
     return results
 
 
 def _transform_allocation_requests_list(alloc_reqs):
     """Turn supplied list of AllocationRequest objects into a list of dicts of
-    resources involved in the allocation request. The returned results is
-    intended to be able to be used as the body of a PUT
-    /allocations/{consumer_uuid} HTTP request, prior to microversion 1.12,
-    so therefore we return a list of JSON objects that looks like the
-    following:
+    resources involved in the allocation request. The allocation entries
+    are _ProviderAllocation holders, so the results are only
+    serializable via this module's _dumps; serialized that way they
+    match the body of a PUT /allocations/{consumer_uuid} HTTP request
+    prior to microversion 1.12 and look like the following:
 
     [
         {
@@ -92,32 +376,55 @@ def _transform_allocation_requests_list(alloc_reqs):
         }, ...
     ]
     """
-    results = []
-    for ar in alloc_reqs:
-        provider_resources = collections.defaultdict(dict)
+    # As in the dict variant, preallocate the output at its known
+    # length.
+    results = [None] * len(alloc_reqs)
+    for i, ar in enumerate(alloc_reqs):
+        provider_resources = {}
         for rr in ar.resource_requests:
-            res_dict = provider_resources[rr.resource_provider.uuid]
+            rp_uuid = rr.resource_provider.uuid
+            res_dict = provider_resources.setdefault(rp_uuid, {})
             res_dict[rr.resource_class] = rr.amount
 
         allocs = [
-            {
-                "resource_provider": {
-                    "uuid": rp_uuid,
-                },
-                "resources": resources,
-            } for rp_uuid, resources in provider_resources.items()
+            _ProviderAllocation(rp_uuid, resources)
+            for rp_uuid, resources in provider_resources.items()
         ]
-        alloc = {
+        results[i] = {
             "allocations": allocs
         }
-        results.append(alloc)
     return results
 
 
-def _transform_provider_summaries(p_sums, include_traits=False):
+def _transform_provider_summaries_no_traits(p_sums):
+    """Turn supplied list of ProviderSummary objects into a dict, keyed by
+    resource provider UUID, of dicts of provider and inventory information,
+    without the traits list.
+
+    This is the specialization of
+    _transform_provider_summaries_with_traits for microversions prior to
+    1.17; keeping it separate means no per-summary branch on the traits
+    flag and no trait name list construction at all.
+    """
+    ret = {}
+
+    for ps in p_sums:
+        resources = {
+            psr.resource_class: {
+                'capacity': psr.capacity,
+                'used': psr.used,
+            } for psr in ps.resources
+        }
+
+        ret[ps.resource_provider.uuid] = {'resources': resources}
+
+    return ret
+
+
+def _transform_provider_summaries_with_traits(p_sums):
     """Turn supplied list of ProviderSummary objects into a dict, keyed by
-    resource provider UUID, of dicts of provider and inventory information. The
-    traits only show up when `include_traits` is `True`.
+    resource provider UUID, of dicts of provider and inventory information,
+    including the traits list (microversion 1.17 and beyond).
 
     {
        RP_UUID_1: {
@@ -165,34 +472,39 @@ def _transform_provider_summaries(p_sums, include_traits=False):
             } for psr in ps.resources
         }
 
-        ret[ps.resource_provider.uuid] = {'resources': resources}
-
-        if include_traits:
-            ret[ps.resource_provider.uuid]['traits'] = [
-                t.name for t in ps.traits]
+        ret[ps.resource_provider.uuid] = {
+            'resources': resources,
+            'traits': [t.name for t in ps.traits],
+        }
 
     return ret
 
 
-def _transform_allocation_candidates(alloc_cands, want_version):
+def _transform_allocation_candidates(alloc_cands, dict_format, include_traits):
     """Turn supplied AllocationCandidates object into a dict containing
     allocation requests and provider summaries.
 
+    The caller has already evaluated the microversion checks once:
+    dict_format is True at microversion 1.12 and beyond, include_traits
+    at 1.17 and beyond. Passing the booleans down avoids repeating the
+    version comparisons here.
+
     {
         'allocation_requests': <ALLOC_REQUESTS>,
         'provider_summaries': <PROVIDER_SUMMARIES>,
     }
     """
-    if want_version.matches((1, 12)):
+    if dict_format:
         a_reqs = _transform_allocation_requests_dict(
             alloc_cands.allocation_requests)
     else:
         a_reqs = _transform_allocation_requests_list(
             alloc_cands.allocation_requests)
 
-    include_traits = want_version.matches((1, 17))
-    p_sums = _transform_provider_summaries(alloc_cands.provider_summaries,
-                                           include_traits=include_traits)
+    transform_ps = (_transform_provider_summaries_with_traits
+                    if include_traits
+                    else _transform_provider_summaries_no_traits)
+    p_sums = transform_ps(alloc_cands.provider_summaries)
     return {
         'allocation_requests': a_reqs,
         'provider_summaries': p_sums,
@@ -210,39 +522,48 @@ def list_allocation_candidates(req):
     a collection of allocation requests and provider summaries
     """
     context = req.environ['placement.context']
-    want_version = req.environ[microversion.MICROVERSION_ENVIRON]
-    get_schema = schema.GET_SCHEMA_1_10
-    if want_version.matches((1, 21)):
-        get_schema = schema.GET_SCHEMA_1_21
-    elif want_version.matches((1, 17)):
-        get_schema = schema.GET_SCHEMA_1_17
-    elif want_version.matches((1, 16)):
-        get_schema = schema.GET_SCHEMA_1_16
+    want_version = req.environ[_MV_KEY]
+    # Evaluate each microversion boundary once; the booleans gate both
+    # the transformations and the response handling below.
+    v_1_12 = want_version.matches((1, 12))
+    v_1_15 = want_version.matches((1, 15))
+    v_1_17 = want_version.matches((1, 17))
+    get_schema = next(
+        get_schema for version, get_schema in _GET_SCHEMA_TABLE
+        if want_version.matches(version))
     util.validate_query_params(req, get_schema)
 
-    requests = util.parse_qs_request_groups(req.GET)
+    requests = _parse_request_groups(
+        req.environ.get('QUERY_STRING', ''), str(want_version))
     limit = req.GET.getall('limit')
     # JSONschema has already confirmed that limit has the form
     # of an integer.
     if limit:
         limit = int(limit[0])
 
+    cands_key = (req.environ.get('QUERY_STRING', ''), str(want_version))
     try:
-        cands = rp_obj.AllocationCandidates.get_by_requests(context, requests,
-                                                            limit)
+        cands = _get_candidates_coalesced(context, cands_key, requests, limit)
     except exception.ResourceClassNotFound as exc:
-        raise webob.exc.HTTPBadRequest(
+        raise _HTTPBadRequest(
             _('Invalid resource class in resources parameter: %(error)s') %
             {'error': exc})
     except exception.TraitNotFound as exc:
-        raise webob.exc.HTTPBadRequest(six.text_type(exc))
+        raise _HTTPBadRequest(str(exc))
 
     response = req.response
-    trx_cands = _transform_allocation_candidates(cands, want_version)
-    json_data = jsonutils.dumps(trx_cands)
-    response.body = encodeutils.to_utf8(json_data)
+    trx_cands = _transform_allocation_candidates(cands, v_1_12, v_1_17)
     response.content_type = 'application/json'
-    if want_version.matches((1, 15)):
+    if v_1_15:
         response.cache_control = 'no-cache'
-        response.last_modified = timeutils.utcnow(with_timezone=True)
+        response.last_modified = _now_utc()
+        # All the headers are known at this point, so stream the body
+        # rather than materializing the serialized bytes (and WebOb's
+        # copy of them) in memory all at once.
+        response.app_iter = _iter_candidates_body(
+            trx_cands['allocation_requests'],
+            trx_cands['provider_summaries'])
+        response.content_length = None
+    else:
+        response.body = _dumps(trx_cands)
     return response
@@ -1403,6 +1403,12 @@ def _get_all_with_shared(ctx, resources, member_of=None):
     sel = sel.where(sa.and_(*where_conds))
     sel = sel.group_by(rpt.c.id)
 
+    # This root-level scan can produce a very large result set when the
+    # filters are wide. Ask the DBAPI to stream rows to us as we iterate
+    # rather than buffering the entire result set client-side first, so
+    # peak memory is one copy of the rows instead of two.
+    sel = sel.execution_options(stream_results=True)
+
     return [r for r in ctx.session.execute(sel)]
 
 
@@ -2916,6 +2922,11 @@ def _get_provider_ids_matching_all(ctx, resources, required_traits,
     sel = sel.select_from(join_chain)
     sel = sel.where(sa.and_(*where_conds))
 
+    # As with _get_all_with_shared, stream the root-level scan so a wide
+    # result set is not fully buffered by the DBAPI before we reduce it
+    # to a list of IDs.
+    sel = sel.execution_options(stream_results=True)
+
     return [r[0] for r in ctx.session.execute(sel)]
 
 
@@ -0,0 +1,170 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Unit tests for the allocation candidate handler helpers."""
+
+import threading
+import time
+
+import mock
+import testtools
+
+from placement.handlers import allocation_candidate as ac
+
+
+class FakeKill(BaseException):
+    """Stands in for an eventlet GreenletExit or SystemExit style kill
+    that bypasses the owner's except Exception handler.
+    """
+
+
+class TestCoalescedCandidates(testtools.TestCase):
+    """Exercise the coalescing of identical in-flight candidate queries.
+
+    The owner/waiter handoff is driven with two real threads and a
+    blocking mock standing in for the database query so that the waiter
+    is guaranteed to arrive while the owner's query is in flight.
+    """
+
+    def setUp(self):
+        super(TestCoalescedCandidates, self).setUp()
+        ac._IN_FLIGHT.clear()
+        conf_patch = mock.patch.object(ac, 'CONF')
+        self.mock_conf = conf_patch.start()
+        self.addCleanup(conf_patch.stop)
+        self.mock_conf.placement.randomize_allocation_candidates = False
+        self.key = ('resources=VCPU:1', '1.21')
+
+    def _run_pair(self, get_by_requests):
+        """Run an owner and a waiter thread through one key.
+
+        get_by_requests blocks until the waiter has joined the in-flight
+        entry, guaranteeing the second thread takes the waiter path.
+        Returns the mock and the outcomes, (value, exception) pairs, in
+        thread start order.
+        """
+        release = threading.Event()
+        outcomes = [None, None]
+
+        def call(index):
+            try:
+                outcomes[index] = (ac._get_candidates_coalesced(
+                    mock.sentinel.context, self.key,
+                    mock.sentinel.requests, mock.sentinel.limit), None)
+            except BaseException as exc:
+                outcomes[index] = (None, exc)
+
+        with mock.patch.object(
+                ac.rp_obj.AllocationCandidates, 'get_by_requests',
+                side_effect=get_by_requests(release)) as mocked:
+            owner = threading.Thread(target=call, args=(0,))
+            owner.start()
+            # Wait for the owner to register itself so the second thread
+            # is certain to become a waiter, then let it block on the
+            # event before releasing the query.
+            while self.key not in ac._IN_FLIGHT:
+                time.sleep(0.01)
+            waiter = threading.Thread(target=call, args=(1,))
+            waiter.start()
+            release.set()
+            owner.join()
+            waiter.join()
+        return mocked, outcomes
+
+    def test_waiter_shares_result(self):
+        def get_by_requests(release):
+            def fake(context, requests, limit):
+                release.wait()
+                return mock.sentinel.cands
+            return fake
+
+        mocked, outcomes = self._run_pair(get_by_requests)
+
+        self.assertEqual(1, mocked.call_count)
+        self.assertEqual((mock.sentinel.cands, None), outcomes[0])
+        self.assertEqual((mock.sentinel.cands, None), outcomes[1])
+        self.assertEqual({}, ac._IN_FLIGHT)
+
+    def test_waiter_shares_exception(self):
+        boom = ValueError('boom')
+
+        def get_by_requests(release):
+            def fake(context, requests, limit):
+                release.wait()
+                raise boom
+            return fake
+
+        mocked, outcomes = self._run_pair(get_by_requests)
+
+        self.assertEqual(1, mocked.call_count)
+        self.assertIs(boom, outcomes[0][1])
+        self.assertIs(boom, outcomes[1][1])
+        self.assertEqual({}, ac._IN_FLIGHT)
+
+    def test_owner_killed_without_publishing(self):
+        def get_by_requests(release):
+            calls = []
+
+            def fake(context, requests, limit):
+                calls.append(None)
+                if len(calls) == 1:
+                    release.wait()
+                    raise FakeKill()
+                return mock.sentinel.cands
+            return fake
+
+        mocked, outcomes = self._run_pair(get_by_requests)
+
+        # The owner was killed without publishing a result or an
+        # exception, so the waiter issued its own query instead of
+        # returning a bogus None.
+        self.assertEqual(2, mocked.call_count)
+        self.assertIsInstance(outcomes[0][1], FakeKill)
+        self.assertEqual((mock.sentinel.cands, None), outcomes[1])
+        self.assertEqual({}, ac._IN_FLIGHT)
+
+    def test_randomize_bypasses_coalescing(self):
+        self.mock_conf.placement.randomize_allocation_candidates = True
+        with mock.patch.object(
+                ac.rp_obj.AllocationCandidates, 'get_by_requests',
+                return_value=mock.sentinel.cands) as mocked:
+            first = ac._get_candidates_coalesced(
+                mock.sentinel.context, self.key,
+                mock.sentinel.requests, mock.sentinel.limit)
+            second = ac._get_candidates_coalesced(
+                mock.sentinel.context, self.key,
+                mock.sentinel.requests, mock.sentinel.limit)
+
+        # Each caller gets its own query so each sees its own ordering.
+        self.assertEqual(2, mocked.call_count)
+        self.assertEqual(mock.sentinel.cands, first)
+        self.assertEqual(mock.sentinel.cands, second)
+        self.assertEqual({}, ac._IN_FLIGHT)
+
+    def test_waiter_times_out_to_direct_query(self):
+        stale = ac._InFlight()
+        ac._IN_FLIGHT[self.key] = stale
+        with mock.patch.object(ac, '_IN_FLIGHT_TIMEOUT', 0.01):
+            with mock.patch.object(
+                    ac.rp_obj.AllocationCandidates, 'get_by_requests',
+                    return_value=mock.sentinel.cands) as mocked:
+                result = ac._get_candidates_coalesced(
+                    mock.sentinel.context, self.key,
+                    mock.sentinel.requests, mock.sentinel.limit)
+
+        # The stale owner never signalled, so the waiter fell back to
+        # its own query and evicted the poisoned entry so later arrivals
+        # do not pay the same wait.
+        self.assertEqual(1, mocked.call_count)
+        self.assertEqual(mock.sentinel.cands, result)
+        self.assertEqual({}, ac._IN_FLIGHT)
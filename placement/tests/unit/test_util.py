@@ -26,6 +26,7 @@ import webob
 import six
 import six.moves.urllib.parse as urlparse
 
+from placement.handlers import allocation_candidate
 from placement import lib as pl
 from placement import microversion
 from placement.objects import resource_provider as rp_obj
@@ -618,6 +619,30 @@ class TestParseQsResourcesAndTraits(testtools.TestCase):
         self.assertRaises(webob.exc.HTTPBadRequest, self.do_parse, qs)
 
 
+class TestCachedRequestGroupCopies(testtools.TestCase):
+    """The allocation candidate handler memoizes query string parsing
+    and hands out per-field copies of the cached RequestGroups; mutating
+    a returned group must not leak into a later cache hit.
+    """
+
+    def test_mutation_does_not_leak_into_cache(self):
+        qs = ('resources=VCPU:2,MEMORY_MB:2048'
+              '&required=HW_CPU_X86_VMX')
+        first = allocation_candidate._parse_request_groups(qs, '1.21')
+        first[0].resources['VCPU'] = 99
+        first[0].required_traits.add('CUSTOM_GOLD')
+        first[0].member_of.append('an-agg-uuid')
+
+        second = allocation_candidate._parse_request_groups(qs, '1.21')
+
+        self.assertEqual({'VCPU': 2, 'MEMORY_MB': 2048},
+                         second[0].resources)
+        self.assertEqual({'HW_CPU_X86_VMX'}, second[0].required_traits)
+        self.assertEqual([], second[0].member_of)
+        # And the copies themselves are distinct objects per call.
+        self.assertIsNot(first[0], second[0])
+
+
 class TestPickLastModified(testtools.TestCase):
 
     def setUp(self):
@@ -0,0 +1,49 @@
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Unit tests for the wsgi module used to launch the Placement service."""
+
+import mock
+import testtools
+
+from placement import wsgi
+
+
+class TestInitApplication(testtools.TestCase):
+    """Confirm init_application builds the app exactly once."""
+
+    def setUp(self):
+        super(TestInitApplication, self).setUp()
+        # Each test starts with no cached application and leaves the
+        # module state the way it found it.
+        self.addCleanup(setattr, wsgi, '_APP', wsgi._APP)
+        wsgi._APP = None
+
+    def test_second_call_returns_cached_app(self):
+        with mock.patch.object(wsgi, '_parse_args') as mock_parse, \
+                mock.patch.object(wsgi, 'db_api'), \
+                mock.patch.object(wsgi, 'setup_logging'), \
+                mock.patch.object(wsgi, 'conf'), \
+                mock.patch.object(wsgi, 'deploy') as mock_deploy:
+            mock_deploy.loadapp.side_effect = [mock.sentinel.app,
+                                               mock.sentinel.other_app]
+            first = wsgi.init_application()
+            second = wsgi.init_application()
+
+        self.assertIs(mock.sentinel.app, first)
+        self.assertIs(first, second)
+        # Config registration and application assembly ran exactly once;
+        # a second _parse_args would raise DuplicateOptError in a real
+        # process.
+        self.assertEqual(1, mock_parse.call_count)
+        self.assertEqual(1, mock_deploy.loadapp.call_count)
@@ -14,9 +14,11 @@
 WSGI handler for running Placement API under Apache2, nginx, gunicorn etc.
 """
 
+import functools
 import logging as py_logging
 import os
 import os.path
+import threading
 
 from oslo_log import log as logging
 from oslo_service import _options as service_opts
@@ -37,6 +39,14 @@ CONFIG_FILE = 'nova.conf'
 
 version_info = pbr.version.VersionInfo('nova')
 
+# Some WSGI containers (for example mod_wsgi with script reloading on)
+# will call init_application more than once in the same process.
+# Re-running config and logging setup is wasted work and re-registering
+# logging options raises DuplicateOptError, so the built application is
+# kept as a process-level singleton.
+_APP = None
+_INIT_LOCK = threading.Lock()
+
 
 def setup_logging(config):
     # Any dependent libraries that have unhelp debug levels should be
@@ -50,7 +60,11 @@ def setup_logging(config):
     py_logging.captureWarnings(True)
 
 
+@functools.lru_cache(maxsize=8)
 def _get_config_file(env=None):
+    # The result never changes after process start, and test harnesses
+    # that drive init_application in a loop call this repeatedly, so the
+    # environment inspection is memoized.
     if env is None:
         env = os.environ
 
@@ -71,23 +85,29 @@ def _parse_args(argv, default_config_files):
 
 
 def init_application():
-    # initialize the config system
-    conffile = _get_config_file()
-    _parse_args([], default_config_files=[conffile])
-    db_api.configure(conf.CONF)
-
-    # initialize the logging system
-    setup_logging(conf.CONF)
-
-    # dump conf at debug (log_options option comes from oslo.service)
-    # FIXME(mriedem): This is gross but we don't have a public hook into
-    # oslo.service to register these options, so we are doing it manually for
-    # now; remove this when we have a hook method into oslo.service.
-    conf.CONF.register_opts(service_opts.service_opts)
-    if conf.CONF.log_options:
-        conf.CONF.log_opt_values(
-            logging.getLogger(__name__),
-            logging.DEBUG)
-
-    # build and return our WSGI app
-    return deploy.loadapp(conf.CONF)
+    global _APP
+    with _INIT_LOCK:
+        if _APP is not None:
+            return _APP
+
+        # initialize the config system
+        conffile = _get_config_file()
+        _parse_args([], default_config_files=[conffile])
+        db_api.configure(conf.CONF)
+
+        # initialize the logging system
+        setup_logging(conf.CONF)
+
+        # dump conf at debug (log_options option comes from oslo.service)
+        # FIXME(mriedem): This is gross but we don't have a public hook into
+        # oslo.service to register these options, so we are doing it manually
+        # for now; remove this when we have a hook method into oslo.service.
+        conf.CONF.register_opts(service_opts.service_opts)
+        if conf.CONF.log_options:
+            conf.CONF.log_opt_values(
+                logging.getLogger(__name__),
+                logging.DEBUG)
+
+        # build and return our WSGI app
+        _APP = deploy.loadapp(conf.CONF)
+        return _APP